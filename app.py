@@ -1,18 +1,37 @@
 import os
-import io
+import gzip
+import json
 import time
+import hashlib
+import hmac
+import threading
+import queue
+import unicodedata
+from types import MappingProxyType
+import brotli
+import jinja2
 import razorpay
+import requests
 import jwt
 import certifi
-from datetime import datetime, timedelta, timezone
-from flask import Flask, jsonify, send_file, render_template, request, url_for
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from urllib.parse import quote
+from cachetools import TLRUCache, TTLCache
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context, url_for
+from flask_compress import Compress
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import IndexModel, MongoClient
+from pymongo.errors import PyMongoError
+from razorpay.errors import SignatureVerificationError
+from requests.adapters import HTTPAdapter
 
 # Google Drive Imports
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleAuthRequest
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
 
 # --- NEW IMPORT FOR RENDER CUSTOM DOMAIN FIX ---
 from werkzeug.middleware.proxy_fix import ProxyFix 
@@ -33,16 +52,66 @@ app.wsgi_app = ProxyFix(
 )
 # ---------------------------------------
 
+# Templates never change in production: don't stat them on every render, and
+# share compiled bytecode between workers and restarts
+app.config['TEMPLATES_AUTO_RELOAD'] = os.getenv('FLASK_DEBUG') == '1'
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache()
+
+# Compress text responses only. PDFs are already compressed, and streamed
+# downloads must not be buffered just to compress them.
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'text/css', 'application/javascript', 'application/json']
+app.config['COMPRESS_STREAMS'] = False
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+Compress(app)
+
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev_key')
 app.config['JWT_SECRET'] = os.getenv('JWT_SECRET', 'dev_jwt_key')
+ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', '1234')
+# How long a purchase unlocks a bundle: token lifetime and Mongo TTL alike
+ACCESS_TTL_SECONDS = 2 * 60 * 60
+# PyJWT signs HS256 through the stdlib hmac module, i.e. OpenSSL's SHA-256
+JWT_ALGORITHM = 'HS256'
+_JWT_KEY = app.config['JWT_SECRET'].encode('utf-8')
+# Tokens only ever carry our own flat claims, so the low-level JWS API is used
+# directly and `exp` is checked by hand instead of via PyJWT's claim validation
+_JWS = jwt.PyJWS(algorithms=[JWT_ALGORITHM])
+
+# Shared outbound connection pool for Razorpay and Google Drive calls
+_HTTP_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+_HTTP = requests.Session()
+_HTTP.mount('https://', _HTTP_ADAPTER)
 
 # Razorpay Keys
 RAZORPAY_KEY_ID = os.getenv('RAZORPAY_KEY_ID')
 RAZORPAY_SECRET = os.getenv('RAZORPAY_SECRET')
 
+# One client per process so payment calls reuse pooled keep-alive connections
+razorpay_client = razorpay.Client(session=_HTTP, auth=(RAZORPAY_KEY_ID, RAZORPAY_SECRET))
+_RAZORPAY_SIGNING_KEY = (RAZORPAY_SECRET or '').encode('utf-8')
+
 # Google Drive Config
 SERVICE_ACCOUNT_FILE = 'gdrive_service_account.json'
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files'
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# When the app runs behind nginx, set this to an internal location that proxies
+# to Drive and nginx will transfer the file instead of the worker, e.g.
+#
+#   location /internal_gdrive/ {
+#       internal;
+#       # Copy the header before proxying; $upstream_http_* is reset by the new request
+#       set $gdrive_auth $upstream_http_x_gdrive_auth;
+#       proxy_pass https://www.googleapis.com/drive/v3/files/;
+#       proxy_set_header Authorization $gdrive_auth;
+#       proxy_set_header Cookie "";
+#       proxy_ssl_server_name on;
+#       proxy_buffering off;
+#   }
+#
+# and add `proxy_hide_header X-Gdrive-Auth;` to the location proxying the app.
+# Range and If-None-Match from the browser are forwarded to Drive unchanged.
+DOWNLOAD_ACCEL_PREFIX = os.getenv('DOWNLOAD_ACCEL_PREFIX')
 
 # Bundle Map
 BUNDLES = {
@@ -78,51 +147,371 @@ BUNDLES = {
     },
 }
 
+@dataclass(frozen=True, slots=True)
+class Bundle:
+    name: str
+    folder_id: str
+    price: int  # paise
+
+# Read-only from here on; routes read bundle.price / bundle.folder_id
+BUNDLES = MappingProxyType({bundle_id: Bundle(**b) for bundle_id, b in BUNDLES.items()})
+
 # --- COUPON CODES ---
-COUPONS = {
+COUPONS = MappingProxyType({
     "ES10": 10,      # 10% Off
     "ES25": 25,      # 25% Off
     "BFF100": 100    # 100% Off (Free)
-}
+})
+
+# Price multipliers for partial-discount coupons, computed once
+_COUPON_MULTIPLIERS = {code: (100 - pct) / 100 for code, pct in COUPONS.items() if pct < 100}
 
 # --- 2. DATABASE CONNECTION ---
+ACCESS_INDEXES = [
+    IndexModel("created_at", name="created_at_1", expireAfterSeconds=ACCESS_TTL_SECONDS),
+    # Also holds the token, so check_access's lookup is answered from the index alone
+    IndexModel([("email", 1), ("bundle_id", 1), ("token", 1)], name="email_bundle_token"),
+]
+LOYALTY_INDEXES = [IndexModel("email", name="email_1", unique=True)]
+
+def ensure_indexes(collection, indexes):
+    # One listIndexes round trip per boot; createIndexes only when something is missing
+    existing = collection.index_information()
+    missing = []
+    for index in indexes:
+        spec = index.document
+        current = existing.get(spec['name'])
+        if current is None:
+            missing.append(index)
+            continue
+        # An index found by name may still have been built with other options
+        if list(spec['key'].items()) != [(field, int(order)) for field, order in current['key']] \
+                or spec.get('unique', False) != current.get('unique', False):
+            print(f"❌ MongoDB Index {spec['name']} on {collection.name} differs from the expected definition")
+        elif spec.get('expireAfterSeconds') != current.get('expireAfterSeconds'):
+            if 'expireAfterSeconds' not in spec:
+                print(f"❌ MongoDB Index {spec['name']} on {collection.name} has an unexpected TTL")
+                continue
+            # TTL changed (e.g. ACCESS_TTL_SECONDS): update it in place
+            collection.database.command('collMod', collection.name, index={
+                'name': spec['name'], 'expireAfterSeconds': spec['expireAfterSeconds']})
+    if missing: collection.create_indexes(missing)
+
+MONGO_URI = os.getenv('MONGO_URI')
+
 try:
-    client = MongoClient(os.getenv('MONGO_URI'), tlsCAFile=certifi.where())
+    # MongoClient(None) would quietly connect to localhost instead
+    if not MONGO_URI: raise RuntimeError("MONGO_URI is not set")
+    client = MongoClient(MONGO_URI, tlsCAFile=certifi.where(),
+                         maxPoolSize=50, minPoolSize=5, waitQueueTimeoutMS=2000,
+                         serverSelectionTimeoutMS=3000, retryWrites=True)
     db = client['notes_app']
-    
+
     # Collection 1: Active Users (Temporary Access)
     access_collection = db['active_users']
-    access_collection.create_index("created_at", expireAfterSeconds=7200)
-    
+
     # Collection 2: Loyalty List (Permanent Discount List)
     loyalty_collection = db['loyalty']
-    
-    print("✅ MongoDB Connected & Rules Set!")
 except Exception as e:
     print(f"❌ MongoDB Error: {e}")
     access_collection = None
     loyalty_collection = None
 
+# Connect now so the first request doesn't pay for the TLS + auth handshake.
+# A failure here is only logged: the collections connect lazily, so a cluster
+# that is briefly unreachable during a deploy doesn't disable them for good.
+if access_collection is not None:
+    try:
+        client.admin.command('ping')
+        ensure_indexes(access_collection, ACCESS_INDEXES)
+        ensure_indexes(loyalty_collection, LOYALTY_INDEXES)
+        print("✅ MongoDB Connected & Rules Set!")
+    except Exception as e:
+        print(f"❌ MongoDB Startup Check Failed: {e}")
+
 # --- 3. HELPER FUNCTIONS ---
 
+# The service account key is read and parsed once per process. Drive clients are
+# pooled and lent to one request at a time, because their httplib2 transport is
+# not thread-safe (and thread-locals would be per request under gevent).
+_drive_creds = None
+_drive_lock = threading.Lock()
+_drive_pool = queue.SimpleQueue()
+
+def get_gdrive_credentials():
+    global _drive_creds
+    if _drive_creds is None:
+        with _drive_lock:
+            if _drive_creds is None:
+                _drive_creds = service_account.Credentials.from_service_account_file(
+                    SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    return _drive_creds
+
+# Read the key at startup so the first request doesn't pay for it
+try:
+    get_gdrive_credentials()
+except Exception as e:
+    print(f"Drive Auth Error: {e}")
+
 def get_gdrive_service():
     try:
-        creds = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-        return build('drive', 'v3', credentials=creds)
+        return build('drive', 'v3', credentials=get_gdrive_credentials(),
+                     cache_discovery=False, static_discovery=True)
     except Exception as e:
         print(f"Drive Auth Error: {e}")
         return None
 
+@contextmanager
+def gdrive_service():
+    # Borrow a pooled Drive client, building one only when all are in use
+    try:
+        service = _drive_pool.get_nowait()
+    except queue.Empty:
+        service = get_gdrive_service()
+    try:
+        yield service
+    finally:
+        if service is not None: _drive_pool.put(service)
+
+# Media downloads go through a plain authorized requests session so the bytes
+# can be streamed to the client as they arrive.
+_drive_session = None
+
+def get_drive_session():
+    global _drive_session
+    if _drive_session is None:
+        creds = get_gdrive_credentials()
+        with _drive_lock:
+            if _drive_session is None:
+                session = AuthorizedSession(creds)
+                session.mount('https://', _HTTP_ADAPTER)
+                _drive_session = session
+    return _drive_session
+
+def get_drive_access_token():
+    creds = get_gdrive_credentials()
+    with _drive_lock:
+        if not creds.valid:
+            creds.refresh(GoogleAuthRequest(_HTTP))
+        return creds.token
+
+def get_current_md5(file_id):
+    # Drive's checksum for the file as it is now, or None if Drive can't say
+    try:
+        with gdrive_service() as service:
+            if not service: return None
+            return service.files().get(fileId=file_id, fields='md5Checksum').execute().get('md5Checksum')
+    except Exception as e:
+        print(f"Drive Metadata Error ({file_id}): {e}")
+        return None
+
+def set_download_headers(response, file_name, etag):
+    response.headers.set('Content-Disposition', 'attachment', **attachment_options(file_name))
+    response.headers['Cache-Control'] = f"private, max-age={DOWNLOAD_BROWSER_TTL}"
+    if etag: response.set_etag(etag)
+    return response
+
+def attachment_options(file_name):
+    # Same Content-Disposition options Flask's send_file would produce
+    try:
+        file_name.encode('ascii')
+        return {'filename': file_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', file_name).encode('ascii', 'ignore').decode('ascii')
+        return {'filename': simple, 'filename*': f"UTF-8''{quote(file_name, safe='')}"}
+
+def sign_token(claims):
+    return _JWS.encode(json.dumps(claims, separators=(',', ':')).encode(), _JWT_KEY, algorithm=JWT_ALGORITHM)
+
+def verify_payment_signature(order_id, payment_id, signature):
+    # Same check as razorpay_client.utility.verify_payment_signature, with the key prepared once
+    msg = f"{order_id}|{payment_id}".encode('utf-8')
+    expected = hmac.new(_RAZORPAY_SIGNING_KEY, msg, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, str(signature)):
+        raise SignatureVerificationError('Razorpay Signature Verification Failed')
+
 def create_access_token(bundle_id):
-    exp = datetime.now(timezone.utc) + timedelta(hours=2)
-    return jwt.encode({'bundle_id': bundle_id, 'exp': exp}, app.config['JWT_SECRET'], algorithm='HS256')
+    exp = int(time.time()) + ACCESS_TTL_SECONDS
+    return sign_token({'bundle_id': bundle_id, 'exp': exp})
+
+def create_file_token(bundle_id, file, exp):
+    # Per-file download link; carries the metadata so /download needs no Drive metadata call
+    claims = {'bundle_id': bundle_id, 'file_id': file['id'], 'file_name': file['name'], 'exp': exp}
+    if 'mimeType' in file: claims['mime_type'] = file['mimeType']
+    if 'size' in file: claims['size'] = file['size']
+    if 'md5Checksum' in file: claims['md5'] = file['md5Checksum']
+    return sign_token(claims)
+
+# Verified tokens are cached so repeat downloads skip the HMAC check.
+# Each entry expires after JWT_CACHE_TTL or at the token's own `exp`, whichever
+# comes first; failed verifications are never cached.
+JWT_CACHE_TTL = 60
+_jwt_cache = TLRUCache(maxsize=10000, ttu=lambda _, claims, now: min(now + JWT_CACHE_TTL, claims['exp']),
+                       timer=time.time)
+_jwt_cache_lock = threading.Lock()
 
 def verify_token(token):
+    key = hashlib.sha256(token.encode()).digest()
+    with _jwt_cache_lock:
+        claims = _jwt_cache.get(key)
+    if claims is not None:
+        return claims
+
     try:
-        return jwt.decode(token, app.config['JWT_SECRET'], algorithms=['HS256'])
-    except:
+        claims = json.loads(_JWS.decode(token, _JWT_KEY, algorithms=[JWT_ALGORITHM]))
+    except (jwt.PyJWTError, ValueError):
         return None
+    if not isinstance(claims, dict) or 'bundle_id' not in claims:
+        return None
+    if not isinstance(claims.get('exp'), int) or claims['exp'] <= time.time():
+        return None
+
+    with _jwt_cache_lock:
+        _jwt_cache[key] = claims
+    return claims
+
+# Drive folder listings, cached per bundle as (files, serialized JSON body, ETag,
+# {encoding: precompressed body}).
+# Folder contents rarely change; browsers revalidate with the ETag after a minute.
+FILES_CACHE_TTL = 300
+FILES_BROWSER_TTL = 60
+FILES_LIST_FIELDS = "nextPageToken, files(id, name, size, mimeType, md5Checksum)"
+# Drive's maximum; the default of 100 would cut larger bundles short
+FILES_PAGE_SIZE = 1000
+FILE_META_FIELDS = "name,size,mimeType,md5Checksum"
+DOWNLOAD_BROWSER_TTL = 3600
+_BUNDLE_QUERIES = {bid: f"'{b.folder_id}' in parents and trashed = false" for bid, b in BUNDLES.items()}
+_FILES_CACHE = TTLCache(maxsize=64, ttl=FILES_CACHE_TTL)
+_FILES_LAST_GOOD = {}
+# Single-flight: one Drive fetch per bundle at a time; other requests wait on its Event
+_FILES_INFLIGHT = {}
+FILES_WAIT_TIMEOUT = 5
+_files_cache_lock = threading.Lock()
+
+# Per-file metadata seen in those listings, so /download can skip its own metadata call
+_FILE_META = TTLCache(maxsize=4096, ttl=FILES_CACHE_TTL)
+
+# Loyalty status changes rarely, so checkout reads it from a local cache first
+_LOYALTY_CACHE = TTLCache(maxsize=50000, ttl=600)
+_loyalty_cache_lock = threading.Lock()
+
+def is_loyal_cached(email):
+    with _loyalty_cache_lock:
+        loyal = _LOYALTY_CACHE.get(email)
+    if loyal is None:
+        try:
+            loyal = loyalty_collection.find_one({"email": email}, projection={"_id": 1}) is not None
+        except PyMongoError as e:
+            # The discount is optional; don't block checkout on it, and ask again next time
+            print(f"❌ MongoDB Loyalty Lookup Error: {e}")
+            return False
+        with _loyalty_cache_lock:
+            _LOYALTY_CACHE[email] = loyal
+    return loyal
+
+# Access rows are written in the background; the response only needs the token
+_db_writer = ThreadPoolExecutor(max_workers=4)
+
+def _log_write_failure(future):
+    if future.exception() is not None:
+        print(f"❌ MongoDB Write Error: {future.exception()}")
+
+def save_access(doc):
+    if access_collection is None: return
+    _db_writer.submit(access_collection.insert_one, doc).add_done_callback(_log_write_failure)
+
+def list_bundle_folders(service, bundle_ids):
+    # One batched Drive request for several folder listings. Raises if the first
+    # bundle's listing failed; the others are simply left uncached.
+    listings, page_tokens, errors = {}, {}, {}
+
+    def list_request(bid, page_token=None):
+        return service.files().list(q=_BUNDLE_QUERIES[bid], fields=FILES_LIST_FIELDS,
+                                    pageSize=FILES_PAGE_SIZE, pageToken=page_token)
+
+    def on_response(bundle_id, response, exception):
+        if exception is not None:
+            errors[bundle_id] = exception
+        else:
+            listings[bundle_id] = response.get('files', [])
+            if response.get('nextPageToken'): page_tokens[bundle_id] = response['nextPageToken']
+
+    batch = service.new_batch_http_request(callback=on_response)
+    for bid in bundle_ids:
+        batch.add(list_request(bid), request_id=bid)
+    batch.execute()
+
+    # Rare: a folder with more than one page of files. Fetch the rest directly.
+    for bid, page_token in page_tokens.items():
+        try:
+            while page_token:
+                response = list_request(bid, page_token).execute()
+                listings[bid].extend(response.get('files', []))
+                page_token = response.get('nextPageToken')
+        except Exception as e:
+            errors[bid] = e
+            del listings[bid]
+
+    if bundle_ids[0] in errors:
+        raise errors[bundle_ids[0]]
+    entries = {}
+    for bid, files in listings.items():
+        body = app.json.dumps({"files": files}).encode()
+        encoded = {'br': brotli.compress(body, mode=brotli.MODE_TEXT), 'gzip': gzip.compress(body)}
+        entries[bid] = (files, body, hashlib.md5(body).hexdigest(), encoded)
+    with _files_cache_lock:
+        for bid, entry in entries.items():
+            _FILES_CACHE[bid] = entry
+            _FILES_LAST_GOOD[bid] = entry
+            for f in entry[0]: _FILE_META[f['id']] = f
+    return entries
+
+def get_folder_listing(bundle_id):
+    # Cached listing entry for a bundle, or None if Drive is unavailable
+    with _files_cache_lock:
+        entry = _FILES_CACHE.get(bundle_id)
+        if entry is not None:
+            return entry
+        event = _FILES_INFLIGHT.get(bundle_id)
+        leader = event is None
+        if leader:
+            event = _FILES_INFLIGHT[bundle_id] = threading.Event()
+
+    if not leader:
+        # Someone is already asking Drive; wait for their result, or fall back to the
+        # last listing we had if Drive is slow
+        event.wait(FILES_WAIT_TIMEOUT)
+        with _files_cache_lock:
+            return _FILES_CACHE.get(bundle_id) or _FILES_LAST_GOOD.get(bundle_id)
+
+    try:
+        with gdrive_service() as service:
+            if service:
+                # Refresh every expired bundle in the same round trip, not just this one
+                with _files_cache_lock:
+                    expired = [bid for bid in BUNDLES if bid != bundle_id and bid not in _FILES_CACHE]
+                return list_bundle_folders(service, [bundle_id] + expired)[bundle_id]
+    except Exception as e:
+        print(f"Drive Listing Error ({bundle_id}): {e}")
+    finally:
+        with _files_cache_lock:
+            del _FILES_INFLIGHT[bundle_id]
+        event.set()
+
+    # Drive failed: serve the last listing we had, same as the waiting requests do
+    with _files_cache_lock:
+        return _FILES_LAST_GOOD.get(bundle_id)
+
+def read_json(required=(), optional=()):
+    # Parse the body once; None unless required fields are non-blank strings
+    # and optional ones are strings or absent
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict): return None
+    for key in required:
+        if not isinstance(data.get(key), str) or not data[key].strip(): return None
+    for key in optional:
+        if data.get(key) is not None and not isinstance(data[key], str): return None
+    return data
 
 # --- 4. ROUTES ---
 
@@ -141,12 +530,33 @@ def api_get_files(bundle_id):
     bundle = BUNDLES.get(bundle_id)
     if not bundle: return jsonify({"error": "Invalid Bundle"}), 404
     
-    service = get_gdrive_service()
-    if not service: return jsonify({"error": "Service Unavailable"}), 500
-    
-    query = f"'{bundle['folder_id']}' in parents and trashed = false"
-    results = service.files().list(q=query, fields="files(id, name)").execute()
-    return jsonify({"files": results.get('files', [])})
+    entry = get_folder_listing(bundle_id)
+    if entry is None: return jsonify({"error": "Service Unavailable"}), 500
+    files, body, etag, encoded = entry
+
+    # Unlocked view: hand out a signed download link per file, valid as long as the access token
+    token = request.args.get('token')
+    claims = verify_token(token) if token else None
+    if claims and claims.get('bundle_id') == bundle_id and 'file_id' not in claims:
+        files = [{**f, 'url': url_for('download_file', file_id=f['id'],
+                                      token=create_file_token(bundle_id, f, claims['exp']))}
+                 for f in files]
+        response = jsonify({"files": files})
+        response.headers['Cache-Control'] = 'private, no-store'
+        return response
+
+    # Compressed once per listing refresh rather than by Flask-Compress on every hit
+    response = Response(body, mimetype='application/json')
+    # best_match honours q-values, so "br;q=0" is never sent Brotli
+    encoding = request.accept_encodings.best_match(('br', 'gzip'))
+    if encoding is not None:
+        response.set_data(encoded[encoding])
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = f"public, max-age={FILES_BROWSER_TTL}"
+    response.make_conditional(request)
+    return response
 
 # --- CHECK ACCESS ---
 @app.route('/check_access', methods=['POST'])
@@ -154,14 +564,20 @@ def check_access():
     if access_collection is None:
         return jsonify({'status': 'expired'})
 
-    data = request.json
-    email = data.get('email', '').lower().strip()
-    bundle_id = data.get('bundle_id')
+    # Rows are keyed by email; a blank one must never match another buyer's row
+    data = read_json(required=('bundle_id', 'email'))
+    if data is None: return jsonify({'status': 'error', 'message': 'Invalid request'}), 400
+    email = data['email'].strip().lower()
+    bundle_id = data['bundle_id']
 
-    user = access_collection.find_one({
-        "email": email,
-        "bundle_id": bundle_id
-    })
+    try:
+        user = access_collection.find_one({
+            "email": email,
+            "bundle_id": bundle_id
+        }, projection={"token": 1, "_id": 0})
+    except PyMongoError as e:
+        print(f"❌ MongoDB Error in check_access: {e}")
+        return jsonify({'status': 'error', 'message': 'Database Unavailable'}), 503
 
     if user:
         return jsonify({
@@ -175,26 +591,27 @@ def check_access():
 # --- REDEEM COUPON (Checks Validity Only) ---
 @app.route('/redeem_coupon', methods=['POST'])
 def redeem_coupon():
-    data = request.json
-    code = data.get('coupon_code', '').strip().upper()
-    email = data.get('email')
-    bundle_id = data.get('bundle_id')
-
-    if code in COUPONS:
-        discount = COUPONS[code]
+    data = read_json(required=('bundle_id', 'email'), optional=('coupon_code',))
+    if data is None or data['bundle_id'] not in BUNDLES:
+        return jsonify({'status': 'invalid', 'message': 'Invalid request'}), 400
+    code = (data.get('coupon_code') or '').strip().upper()
+    email = data['email'].strip().lower()
+    bundle_id = data['bundle_id']
+
+    discount = COUPONS.get(code)
+    if discount is not None:
         
         # Scenario A: 100% Off (Free Access)
         if discount == 100:
             token = create_access_token(bundle_id)
-            if access_collection is not None:
-                access_collection.insert_one({
-                    "email": email,
-                    "bundle_id": bundle_id,
-                    "token": token,
-                    "created_at": datetime.utcnow(),
-                    "payment_method": "COUPON",
-                    "coupon_used": code
-                })
+            save_access({
+                "email": email,
+                "bundle_id": bundle_id,
+                "token": token,
+                "created_at": datetime.now(timezone.utc),
+                "payment_method": "COUPON",
+                "coupon_used": code
+            })
             return jsonify({
                 'status': 'success', 
                 'token': token, 
@@ -214,32 +631,29 @@ def redeem_coupon():
 @app.route('/create_order', methods=['POST'])
 def create_order():
     try:
-        data = request.json
-        if not data: return jsonify({'error': 'No data received'}), 400
+        data = read_json(required=('bundle_id',), optional=('email', 'coupon_code'))
+        if data is None: return jsonify({'error': 'Invalid request data'}), 400
 
-        bundle_id = data.get('bundle_id')
-        user_email = data.get('email', '').lower().strip()
-        coupon_code = data.get('coupon_code', '').upper().strip()
+        bundle_id = data['bundle_id']
+        user_email = (data.get('email') or '').strip().lower()
+        coupon_code = (data.get('coupon_code') or '').strip().upper()
         
         bundle = BUNDLES.get(bundle_id)
         if not bundle: return jsonify({'error': 'Invalid Bundle'}), 400
 
-        final_price = bundle['price']
+        final_price = bundle.price
         
         # 1. Check Loyalty (50% Off)
         if loyalty_collection is not None:
-            is_loyal = loyalty_collection.find_one({"email": user_email})
-            if is_loyal:
+            if is_loyal_cached(user_email):
                 final_price = int(final_price * 0.5) 
                 print(f"🎉 Loyalty Discount Applied for {user_email}")
 
         # 2. Check Coupon (Partial Discount)
-        if coupon_code in COUPONS:
-            discount_percent = COUPONS[coupon_code]
-            if discount_percent < 100:
-                multiplier = (100 - discount_percent) / 100
-                final_price = int(final_price * multiplier)
-                print(f"🎟️ Coupon {coupon_code} applied: {discount_percent}% Off")
+        multiplier = _COUPON_MULTIPLIERS.get(coupon_code)
+        if multiplier is not None:
+            final_price = int(final_price * multiplier)
+            print(f"🎟️ Coupon {coupon_code} applied: {COUPONS[coupon_code]}% Off")
 
         # Guard: Minimum Razorpay Amount
         if final_price < 100: final_price = 100
@@ -248,8 +662,7 @@ def create_order():
         if not RAZORPAY_KEY_ID or not RAZORPAY_SECRET:
              return jsonify({'error': 'Razorpay Keys Missing on Server'}), 500
 
-        client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_SECRET))
-        order = client.order.create({
+        order = razorpay_client.order.create({
             'amount': final_price,
             'currency': 'INR',
             'payment_capture': '1'
@@ -267,24 +680,25 @@ def create_order():
 
 @app.route('/verify_payment', methods=['POST'])
 def verify_payment():
-    data = request.json
+    if not RAZORPAY_KEY_ID or not RAZORPAY_SECRET:
+        return jsonify({'status': 'error', 'message': 'Razorpay Keys Missing on Server'}), 500
+
+    data = read_json(required=('razorpay_order_id', 'razorpay_payment_id', 'razorpay_signature', 'bundle_id',
+                               'user_email'))
+    if data is None or data['bundle_id'] not in BUNDLES:
+        return jsonify({'status': 'error', 'message': 'Invalid request'}), 400
     try:
-        client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_SECRET))
-        client.utility.verify_payment_signature({
-            'razorpay_order_id': data['razorpay_order_id'],
-            'razorpay_payment_id': data['razorpay_payment_id'],
-            'razorpay_signature': data['razorpay_signature']
-        })
+        verify_payment_signature(data['razorpay_order_id'], data['razorpay_payment_id'],
+                                 data['razorpay_signature'])
         
         token = create_access_token(data['bundle_id'])
         
-        if access_collection is not None:
-            access_collection.insert_one({
-                "email": data.get('user_email'),
-                "bundle_id": data['bundle_id'],
-                "token": token,
-                "created_at": datetime.utcnow()
-            })
+        save_access({
+            "email": data['user_email'].strip().lower(),
+            "bundle_id": data['bundle_id'],
+            "token": token,
+            "created_at": datetime.now(timezone.utc)
+        })
         
         return jsonify({'status': 'success', 'token': token})
 
@@ -295,25 +709,84 @@ def verify_payment():
 @app.route('/download/<file_id>')
 def download_file(file_id):
     token = request.args.get('token')
-    if not token or not verify_token(token):
+    claims = verify_token(token) if token else None
+    if not claims:
         return "❌ ACCESS DENIED: Link Expired.", 403
-
-    service = get_gdrive_service()
+    if claims.get('file_id', file_id) != file_id:
+        return "❌ ACCESS DENIED: Link is for a different file.", 403
+
+    if 'file_name' in claims:
+        meta = {'name': claims['file_name']}
+        if 'mime_type' in claims: meta['mimeType'] = claims['mime_type']
+        if 'size' in claims: meta['size'] = claims['size']
+        if 'md5' in claims: meta['md5Checksum'] = claims['md5']
+    else:
+        with _files_cache_lock:
+            meta = _FILE_META.get(file_id)
     try:
-        meta = service.files().get(fileId=file_id).execute()
+        if meta is None:
+            with gdrive_service() as service:
+                if not service: return "Error: Drive Unavailable", 500
+                meta = service.files().get(fileId=file_id, fields=FILE_META_FIELDS).execute()
+            with _files_cache_lock:
+                _FILE_META[file_id] = meta
         file_name = meta.get('name', 'download.pdf')
-        
-        drive_request = service.files().get_media(fileId=file_id)
-        file_stream = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_stream, drive_request)
-        
-        done = False
-        while not done: _, done = downloader.next_chunk()
-        file_stream.seek(0)
-        
-        return send_file(file_stream, as_attachment=True, download_name=file_name)
+        mimetype = meta.get('mimeType', 'application/octet-stream')
+
+        # Drive's checksum identifies the content; a browser that already has it gets a 304
+        etag = meta.get('md5Checksum')
+        if etag and request.if_none_match.contains(etag):
+            return set_download_headers(Response(status=304), file_name, etag)
+
+        if DOWNLOAD_ACCEL_PREFIX:
+            # nginx fetches the bytes from Drive; this worker is done after the headers
+            response = Response(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = f"{DOWNLOAD_ACCEL_PREFIX}{file_id}?alt=media"
+            response.headers['X-Gdrive-Auth'] = f"Bearer {get_drive_access_token()}"
+            return set_download_headers(response, file_name, etag)
+
+        # Ask for the raw bytes, and pass Range through so interrupted downloads can resume.
+        # Drive ignores If-Range, so check it here: if the file was revised since the
+        # partial download started, send the whole new file instead of a slice of it.
+        # The md5 in the token or cache may predate the revision, so ask Drive for
+        # the current one (resumes only).
+        upstream_headers = {'Accept-Encoding': 'identity'}
+        range_header = request.headers.get('Range')
+        if_range = request.if_range
+        if range_header and if_range.etag is not None:
+            current_md5 = get_current_md5(file_id)
+            if current_md5: etag = current_md5
+            if not current_md5 or if_range.etag != current_md5: range_header = None
+        elif range_header and if_range.date is not None:
+            range_header = None
+        if range_header: upstream_headers['Range'] = range_header
+        upstream = get_drive_session().get(
+            f"{DRIVE_FILES_URL}/{file_id}", params={'alt': 'media'}, headers=upstream_headers, stream=True)
+        if upstream.status_code == 416:
+            upstream.close()
+            return "Requested Range Not Satisfiable", 416
+        if not upstream.ok:
+            upstream.close()
+            upstream.raise_for_status()
     except Exception as e:
         return f"Error: {e}", 500
+
+    def generate():
+        for chunk in upstream.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            yield chunk
+
+    response = Response(stream_with_context(generate()), status=upstream.status_code, mimetype=mimetype)
+    # Runs even if the body is never iterated (HEAD, or the client leaves before
+    # the first chunk), so the Drive connection is always released
+    response.call_on_close(upstream.close)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if 'Content-Range' in upstream.headers: response.headers['Content-Range'] = upstream.headers['Content-Range']
+    content_length = upstream.headers.get('Content-Length')
+    # The known size is only trusted for a full response of the revision it was read from
+    if content_length is None and upstream.status_code == 200 and etag == meta.get('md5Checksum'):
+        content_length = meta.get('size')
+    if content_length: response.headers['Content-Length'] = content_length
+    return set_download_headers(response, file_name, etag)
     
 @app.route('/about')
 def about():
@@ -325,18 +798,34 @@ def about():
 def add_loyal():
     if loyalty_collection is None: return "DB Error"
     
-    email = request.args.get('email')
+    email = (request.args.get('email') or '').strip().lower()
     password = request.args.get('pw')
     
-    if not email or password != '1234': 
+    if not email or password != ADMIN_PASSWORD: 
         return "❌ Access Denied"
     
     loyalty_collection.update_one(
-        {"email": email.lower().strip()}, 
-        {"$set": {"email": email.lower().strip()}}, 
+        {"email": email}, 
+        {"$set": {"email": email}}, 
         upsert=True
     )
+    with _loyalty_cache_lock:
+        _LOYALTY_CACHE.pop(email, None)
     return f"✅ Added {email} to Loyalty List! They will get 50% off."
 
+# --- SECRET ROUTE: REFRESH A BUNDLE'S FILE LIST ---
+# Visit: /api/files/ds/refresh?pw=1234 after adding or renaming files in Drive
+@app.route('/api/files/<bundle_id>/refresh')
+def refresh_files(bundle_id):
+    if request.args.get('pw') != ADMIN_PASSWORD:
+        return "❌ Access Denied"
+    if bundle_id not in BUNDLES:
+        return "❌ Invalid Bundle", 404
+
+    with _files_cache_lock:
+        _FILES_CACHE.pop(bundle_id, None)
+    return f"✅ File list for {bundle_id} will be reloaded from Drive on the next request."
+
+# Local development only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1')
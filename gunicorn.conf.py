@@ -0,0 +1,20 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app`.
+# Downloads and Drive/Razorpay/MongoDB calls are I/O-bound, so each worker
+# handles many requests concurrently instead of one at a time.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# cpu_count() reports the host's CPUs, not the container's quota, and every
+# worker holds its own MongoDB pool and Drive clients, so keep the default small
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+
+# gevent runs each request as a greenlet, so a worker can hold many open
+# downloads and upstream calls at once instead of one per thread.
+# Set GUNICORN_WORKER_CLASS=gthread to fall back to plain threads.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+# Heartbeat files on tmpfs so a slow disk can't stall workers
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'